@@ -18,17 +18,24 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 ################################################################################
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from functools import lru_cache
+from io import StringIO
+from itertools import repeat
+from multiprocessing import get_context
 import os
 import re
 from subprocess import run
-from tempfile import NamedTemporaryFile
+from threading import Thread
 from enum import Enum
 import logging
+import numpy as np
 import ROOT
 
 from mycolour import Colour
-from rootutils import get_list_of_keys_deep
+from rootutils import TFileContext, get_key, get_list_of_keys_deep, get_bin_contents, prefetch_keys, read_key_payload
 
 class ExitStatus(Enum):
     IDENTICAL         = 0
@@ -42,6 +49,15 @@ class ExitStatus(Enum):
     DIFFERENCE_COMMON = 13 # This is bad
 
 
+def print_plot_ok(name, verbosity=0):
+    '''
+    Report a plot with the same content in both files, at the highest verbosity
+    '''
+    if(verbosity >= 5):
+        print('#', name, '#')
+        print('\tOK')
+
+
 def compare_plot(h1, h2, verbosity=0, **kwargs):
     '''
     Detailed comparison of two TH1, bin by bin
@@ -79,28 +95,48 @@ def compare_plot(h1, h2, verbosity=0, **kwargs):
     print_wrong_plot = verbosity >= 2
     print_good_plot  = verbosity >= 4
     print_every_bin  = verbosity >= 3
-    print_ok         = verbosity >= 5
 
     fmt_ncells = '{:%dd}' % ( len(str(ncells1)) )
     fmt = '\t'+fmt_ncells+': {:.3e} - {:.3e} - diff = {:+.3e}'
 
-    ok_content = True
+    a1 = get_bin_contents(h1)
+    a2 = get_bin_contents(h2)
 
-    for b in range(0, ncells1):
-        c1 = h1.GetBinContent(b)
-        c2 = h2.GetBinContent(b)
-        if(c1 != c2):
-            ok_content = False
-            if(print_every_bin):
-                print_header()
+    if(a1 is not None and a2 is not None):
+        # Compare the whole arrays at once instead of calling GetBinContent for each bin
+        diff_mask = np.not_equal(a1, a2)
+        n_diff = int(diff_mask.sum())
+        ok_content = n_diff == 0
+        if(not ok_content and print_every_bin):
+            print_header()
+            for b in np.flatnonzero(diff_mask):
+                c1 = float(a1[b])
+                c2 = float(a2[b])
                 print(fmt.format(b, c1, c2, c2-c1))
-            else:
-                break  # Don't need to continue
+    else:
+        ok_content = True
+
+        for b in range(0, ncells1):
+            c1 = h1.GetBinContent(b)
+            c2 = h2.GetBinContent(b)
+            if(c1 != c2):
+                ok_content = False
+                if(print_every_bin):
+                    print_header()
+                    print(fmt.format(b, c1, c2, c2-c1))
+                else:
+                    break  # Don't need to continue
 
     if((print_wrong_plot or print_good_plot) and not print_every_bin):
         if(not ok_content):
-            integral1 = h1.Integral(*[0, -1]*h1.GetDimension())
-            integral2 = h2.Integral(*[0, -1]*h1.GetDimension())
+            if(a1 is not None and a2 is not None):
+                # Same as Integral(0, -1) on every axis, since the arrays include under/overflow.
+                # Histograms with a pending entry buffer have no array and use Integral, which empties it
+                integral1 = a1.sum(dtype=np.float64)
+                integral2 = a2.sum(dtype=np.float64)
+            else:
+                integral1 = h1.Integral(*[0, -1]*h1.GetDimension())
+                integral2 = h2.Integral(*[0, -1]*h1.GetDimension())
             if(integral1 == integral2):
                 print('{:48s} DIFFERENT!  But same integral: {:6.3g}'.format(name, integral1))
             else:
@@ -108,28 +144,104 @@ def compare_plot(h1, h2, verbosity=0, **kwargs):
         elif(print_good_plot):
             print('{:48s} equal     '.format(name)) #  ' Integrals --> h1: {:.2g} - h2: {:.2g}'.format(plot, h1.Integral(0, -1), h2.Integral(0, -1)))
 
-    if(ok_content and print_ok):
-        print_header()
-        print('\tOK')
+    if(ok_content):
+        print_plot_ok(name, verbosity=verbosity)
 
     return ok_content
 
 
-def diff_full(keys1, keys2, **kwargs):
-    with NamedTemporaryFile(mode='w') as temp1, NamedTemporaryFile(mode='w') as temp2:
-        temp1.write('\n'.join(sorted(keys1))+'\n')
-        temp2.write('\n'.join(sorted(keys2))+'\n')
-        diff_proc = run(['diff', '--minimal', temp1.name, temp2.name], capture_output=True, encoding='utf-8')
-        if(diff_proc.returncode == 2):
-            print('ERROR in diff')
-            exit(ExitStatus.INTERNAL_ERROR.value)
-        if(verbosity >= 1):
-            print( diff_proc.stdout )
+def same_th1_payload(tf1, k1, tf2, k2):
+    '''
+    Check if two keys hold histograms of the same class whose bytes on disk are identical
+    '''
+    if(k1.GetClassName() != k2.GetClassName() or k1.GetObjlen() != k2.GetObjlen() or k1.GetNbytes() - k1.GetKeylen() != k2.GetNbytes() - k2.GetKeylen()):
+        return False
+    cl = ROOT.TClass.GetClass(k1.GetClassName())
+    if(not cl or not cl.InheritsFrom('TH1')):
+        return False  # Let compare_plot decide what to do with other objects
+    payload1 = read_key_payload(tf1, k1)
+    return payload1 is not None and payload1 == read_key_payload(tf2, k2)
+
+
+def compare_common(tf1, tf2, keys1_map, keys2_map, plots, verbosity=0):
+    '''
+    Compare the objects at the given paths in the two files, in the given order.
+    Return the number of plots with same and different content, and the output of each comparison
+    '''
+    ok = bad = 0
+    plot_outputs = {}
+
+    tkeys1 = prefetch_keys(tf1, (keys1_map[plot] for plot in plots))
+    tkeys2 = prefetch_keys(tf2, (keys2_map[plot] for plot in plots))
+    for plot, k1, k2 in zip(plots, tkeys1, tkeys2):
+        if(same_th1_payload(tf1, k1, tf2, k2)):
+            # Identical bytes on disk: no need to unstream the histograms
+            ok += 1
+            with redirect_stdout(StringIO()) as plot_output:
+                print_plot_ok(k1.GetName(), verbosity=verbosity)
+            plot_outputs[plot] = plot_output.getvalue()
+            continue
+
+        # Read directly from the TKeys, instead of looking up the path again with TFile::Get
+        h1 = k1.ReadObj()
+        h2 = k2.ReadObj()
+        assert h1 and h2, 'Unable to retrieve both plots "'+plot+'" from the files'
+        with redirect_stdout(StringIO()) as plot_output:
+            # compare_plot returns None for objects it can't compare
+            ok_content = bool(compare_plot(h1, h2, verbosity=verbosity))
+        plot_outputs[plot] = plot_output.getvalue()
+        ok  += ok_content
+        bad += not ok_content
+
+    return ok, bad, plot_outputs
+
+
+def compare_common_files(file1, file2, plots, verbosity=0):
+    '''
+    Open the two files and run compare_common on them; used by the worker processes
+    '''
+    with TFileContext(file1, 'READ') as tf1, TFileContext(file2, 'READ') as tf2:
+        # Look up only the keys of this chunk, instead of walking both files again
+        keys1_map = {plot: get_key(tf1, plot) for plot in plots}
+        keys2_map = {plot: get_key(tf2, plot) for plot in plots}
+        assert all(keys1_map.values()) and all(keys2_map.values()), 'Unable to retrieve the keys of the chunk from the files'
+        return compare_common(tf1, tf2, keys1_map, keys2_map, plots, verbosity=verbosity)
+
+
+def diff_full(sorted_keys1, sorted_keys2, verbosity=0, **kwargs):
+    '''
+    Run diff on the sorted lists of keys. The first list is passed on stdin and the
+    second through a pipe opened as /dev/fd/N, so that nothing is written to disk
+    '''
+    text1 = '\n'.join(sorted_keys1)+'\n'
+    text2 = ('\n'.join(sorted_keys2)+'\n').encode('utf-8')
+
+    read2, write2 = os.pipe()
+    def feed_pipe():
+        try:
+            with open(write2, 'wb') as pipe2:
+                pipe2.write(text2)
+        except BrokenPipeError:
+            pass  # diff exited without reading everything
+
+    feeder = Thread(target=feed_pipe)
+    feeder.start()
+    try:
+        diff_proc = run(['diff', '--minimal', '-', '/dev/fd/%d' % (read2)], input=text1, pass_fds=(read2,), capture_output=True, encoding='utf-8')
+    finally:
+        os.close(read2)
+        feeder.join()
+
+    if(diff_proc.returncode == 2):
+        print('ERROR in diff')
+        exit(ExitStatus.INTERNAL_ERROR.value)
+    if(verbosity >= 1):
+        print( diff_proc.stdout )
     return diff_proc.returncode
 
 
 def get_fmt(a, b, tot):
-    return '{:%dd}/{:%dd} ({:5.1f} %%)' % (
+    return _get_fmt_widths(
         max(
             len(str(a)),
             len(str(b))
@@ -138,6 +250,11 @@ def get_fmt(a, b, tot):
     )
 
 
+@lru_cache(maxsize=32)
+def _get_fmt_widths(width, width_tot):
+    return '{:%dd}/{:%dd} ({:5.1f} %%)' % (width, width_tot)
+
+
 def print_missing(missing1, missing2, common, verbosity=0, **kwargs):
     print_every_plot        = verbosity >= 2
     print_every_plot_common = verbosity >= 4
@@ -184,23 +301,34 @@ def print_content_status(content_status):
 
 
 def diff_set(keys1, keys2, **kwargs):
-    missing1 = keys2 - keys1
-    missing2 = keys1 - keys2
-    kwargs.setdefault('common', missing1 & missing2)
+    common = keys1 & keys2
+    # Plain set differences run in C and are faster than an explicit comprehension
+    missing1 = keys2 - common
+    missing2 = keys1 - common
+    kwargs.setdefault('common', common)
 
-    print_missing(missing1, missing2, total=len(keys1|keys2), **kwargs)
+    # Size of keys1|keys2, without building the union
+    total = len(keys1) + len(keys2) - len(common)
+    print_missing(missing1, missing2, total=total, **kwargs)
 
     # NOTE: if any of the the common plots differ, this function won't detect it
     # This was made as a simpler implementation to test the more complicated print_missing
     if  (len(missing2) > 0):
         return ExitStatus.SECOND_MISS.value
-    elif(len(missing2) > 0):
+    elif(len(missing1) > 0):
         return ExitStatus.FIRST_MISS.value
     else:
-        ExitStatus.IDENTICAL.value
+        return ExitStatus.IDENTICAL.value
+
+
+def non_negative_int(value):
+    n = int(value)
+    if(n < 0):
+        raise ArgumentTypeError('must be >= 0, got %d' % (n))
+    return n
 
 
-def parse_args():
+def _build_parser():
     parser = ArgumentParser('Compare the content of two ROOT files, key by key')
 
     parser.add_argument('file1', metavar='FILE1')
@@ -209,6 +337,7 @@ def parse_args():
     parser.add_argument(      '--plot-exclude', type=re.compile, help='Second regexp to exclude some of the selected plots')
     parser.add_argument(      '--diff', action='store_true', help='Use diff to compare the sorted lists of keys')
     parser.add_argument(      '--set' , action='store_true', help='Use the simpler comparison, which just checks if both files have the same keys')
+    parser.add_argument('-j', '--jobs', type=non_negative_int, default=1, metavar='N', help='Compare the common plots in N processes (0 = number of CPUs). Default: %(default)s')
     parser.add_argument('-v', '--verbose', dest='verbosity',
                         action='count', default=1,
                         help='increase verbosity')
@@ -220,7 +349,14 @@ def parse_args():
                         help='set verbose to minimum')
     parser.add_argument('--log', dest='loglevel', metavar='LEVEL', default='WARNING', help='Level for the python logging module. Can be either a mnemonic string like DEBUG, INFO or WARNING or an integer (lower means more verbose).')
 
-    return parser.parse_args()
+    return parser
+
+
+# Built once at import, so that parse_args can be called repeatedly
+_PARSER = _build_parser()
+
+def parse_args(args=None):
+    return _PARSER.parse_args(args)
 
 
 def main():
@@ -231,6 +367,12 @@ def main():
 
     logging.info('args: %s', args)
 
+    # Catch the obvious case before opening the files, which can be slow for remote ones.
+    # Files that are the same only once opened are detected below
+    if(os.path.exists(args.file1) and os.path.exists(args.file2) and os.path.samefile(args.file1, args.file2)):
+        logging.error('The two files are the same!')
+        return ExitStatus.CLARG_ERROR.value
+
     tf1 = ROOT.TFile(args.file1, 'READ')
     tf2 = ROOT.TFile(args.file2, 'READ')
     stat1 = os.fstat(tf1.GetFd())
@@ -242,11 +384,13 @@ def main():
         return ExitStatus.CLARG_ERROR.value
 
     logging.info('Extracting keys from file1...')
-    keys1 = set(get_list_of_keys_deep(tf1))
+    keys1_map = dict(get_list_of_keys_deep(tf1))
+    keys1 = keys1_map.keys()
     # keys1 = { k.GetName() for k in tf.GetListOfKeys() }
 
     logging.info('Extracting keys from file2...')
-    keys2 = set(get_list_of_keys_deep(tf2))
+    keys2_map = dict(get_list_of_keys_deep(tf2))
+    keys2 = keys2_map.keys()
     # keys2 = { k.GetName() for k in tf.GetListOfKeys() }
 
     logging.info('Now comparing keys')
@@ -254,7 +398,7 @@ def main():
     if  (args.diff):
         tf1.Close()
         tf2.Close()
-        diff_retcode = diff_full(keys1, keys2, verbosity=args.verbosity)
+        diff_retcode = diff_full(sorted(keys1), sorted(keys2), verbosity=args.verbosity)
         if(diff_retcode == 1):
             return ExitStatus.EITHER_MISS.value
         else:
@@ -265,24 +409,34 @@ def main():
         return diff_set(keys1, keys2, verbosity=args.verbosity)
 
     # Select keys
-    matching_keys = keys1 | keys2
+    all_keys = keys1 | keys2
+    matching_keys = all_keys
     if(args.verbosity >= 1):
-        print('Total keys =', len(matching_keys))
+        print('Total keys =', len(all_keys))
+
+    # Apply both regexps in a single pass, counting the keys selected by --plot
+    # before the exclusion, for the printouts
+    include = args.plot.search         if args.plot         is not None else None
+    exclude = args.plot_exclude.search if args.plot_exclude is not None else None
+    if(include is not None or exclude is not None):
+        n_included = 0
+        matching_keys = set()
+        for k in all_keys:
+            if(include is None or include(k)):
+                n_included += 1
+                if(exclude is None or not exclude(k)):
+                    matching_keys.add(k)
 
     if(args.plot is not None):
-        matching_keys = { k for k in keys1|keys2 if args.plot.search(k)}
-        if(len(matching_keys) == 0):
+        if(n_included == 0):
             tf1.Close()
             tf2.Close()
             logging.error('no keys matching "%s"', args.plot.pattern)
             return ExitStatus.CLARG_ERROR.value  # User specified a regex which does not match anything
         if(args.verbosity >= 1):
-            print('... of which matching regex', args.plot.pattern, '=', Colour.green(str(len(matching_keys))))
+            print('... of which matching regex', args.plot.pattern, '=', Colour.green(str(n_included)))
 
     if(args.plot_exclude is not None):
-        # plot_exclude_regex_list = [re.compile(e) for e in args.plot_exclude]
-        # matching_keys = { k for k in matching_keys if not any(exclude_regex.search(k) for exclude_regex in plot_exclude_regex_list)}
-        matching_keys = { k for k in matching_keys if not args.plot_exclude.search(k) }
         if(len(matching_keys) == 0):
             tf1.Close()
             tf2.Close()
@@ -294,25 +448,56 @@ def main():
         print()
 
     # Actual in-depth comparison of plots
-    missing_keys = {1:matching_keys - keys1, 2: matching_keys - keys2}
-    common_keys = matching_keys & keys1 & keys2
-
-    content_status = {'OK': 0, 'BAD': 0}
-
-    if(True):
-        for plot in sorted(common_keys):
-            h1 = tf1.Get(plot)
-            h2 = tf2.Get(plot)
-            assert h1 and h2, 'Unable to retrieve both plots "'+plot+'" from the files'
-            ok_content = compare_plot(h1, h2, verbosity=args.verbosity)
-            if(ok_content): content_status['OK']  += 1
-            else          : content_status['BAD'] += 1
+    # Partition the matching keys in a single pass. Every matching key comes from
+    # keys1|keys2, so if it is not in keys1 it must be in keys2
+    missing_keys = {1: set(), 2: set()}
+    common_keys = set()
+    for k in matching_keys:
+        if  (k not in keys1):
+            missing_keys[1].add(k)
+        elif(k not in keys2):
+            missing_keys[2].add(k)
+        else:
+            common_keys.add(k)
+
+    # Read the keys in the order they are stored on disk (roughly, for both files)
+    # to avoid random seeks. The output of each comparison is buffered and then
+    # printed in alphabetical order
+    def seek_order(plot):
+        return keys1_map[plot].GetSeekKey() + keys2_map[plot].GetSeekKey()
+
+    # The alphabetical order is needed for the printouts; the same list is passed to
+    # print_missing, where sorting it again is linear
+    sorted_common_keys = sorted(common_keys)
+    plots = sorted(common_keys, key=seek_order)
+
+    jobs = min(args.jobs or os.cpu_count() or 1, len(plots))
+    if(jobs <= 1):
+        ok, bad, plot_outputs = compare_common(tf1, tf2, keys1_map, keys2_map, plots, verbosity=args.verbosity)
+    else:
+        # Contiguous chunks, so that each worker still reads its keys sequentially.
+        # The workers open their own TFiles: use spawn, since the open ones can't be shared
+        chunk_size = -(-len(plots) // jobs)
+        chunks = [plots[i:i+chunk_size] for i in range(0, len(plots), chunk_size)]
+        logging.info('Comparing %d keys in %d processes', len(plots), len(chunks))
+
+        ok = bad = 0
+        plot_outputs = {}
+        with ProcessPoolExecutor(max_workers=len(chunks), mp_context=get_context('spawn')) as executor:
+            for chunk_ok, chunk_bad, chunk_outputs in executor.map(compare_common_files, repeat(args.file1), repeat(args.file2), chunks, repeat(args.verbosity)):
+                ok  += chunk_ok
+                bad += chunk_bad
+                plot_outputs.update(chunk_outputs)
+
+    for plot in sorted_common_keys:
+        print(plot_outputs[plot], end='')
+    content_status = {'OK': ok, 'BAD': bad}
 
     tf1.Close()
     tf2.Close()
 
     if(args.verbosity >= 1):
-        print_missing(missing_keys[1], missing_keys[2], common=common_keys, verbosity=args.verbosity, total=len(matching_keys))
+        print_missing(missing_keys[1], missing_keys[2], common=sorted_common_keys, verbosity=args.verbosity, total=len(matching_keys))
         print_content_status(content_status)
 
     if  (content_status['BAD'] > 0):
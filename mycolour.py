@@ -31,13 +31,23 @@ class Colour:
     s_warn       = '\033[0;43m'    
     s_evidence   = '\033[1;91;103m'
 
-    def white    (st): return Colour.s_white     + str(st) + Colour.s_terminator
-    def red      (st): return Colour.s_red       + str(st) + Colour.s_terminator
-    def green    (st): return Colour.s_green     + str(st) + Colour.s_terminator
-    def yellow   (st): return Colour.s_yellow    + str(st) + Colour.s_terminator
-    def blue     (st): return Colour.s_blue      + str(st) + Colour.s_terminator
-    def violet   (st): return Colour.s_violet    + str(st) + Colour.s_terminator
-    def important(st): return Colour.s_important + str(st) + Colour.s_terminator
-    def ok       (st): return Colour.s_ok        + str(st) + Colour.s_terminator
-    def warn     (st): return Colour.s_warn      + str(st) + Colour.s_terminator
-    def evidence (st): return Colour.s_evidence  + str(st) + Colour.s_terminator
+    @staticmethod
+    def white    (st): return f'{Colour.s_white}{st}{Colour.s_terminator}'
+    @staticmethod
+    def red      (st): return f'{Colour.s_red}{st}{Colour.s_terminator}'
+    @staticmethod
+    def green    (st): return f'{Colour.s_green}{st}{Colour.s_terminator}'
+    @staticmethod
+    def yellow   (st): return f'{Colour.s_yellow}{st}{Colour.s_terminator}'
+    @staticmethod
+    def blue     (st): return f'{Colour.s_blue}{st}{Colour.s_terminator}'
+    @staticmethod
+    def violet   (st): return f'{Colour.s_violet}{st}{Colour.s_terminator}'
+    @staticmethod
+    def important(st): return f'{Colour.s_important}{st}{Colour.s_terminator}'
+    @staticmethod
+    def ok       (st): return f'{Colour.s_ok}{st}{Colour.s_terminator}'
+    @staticmethod
+    def warn     (st): return f'{Colour.s_warn}{st}{Colour.s_terminator}'
+    @staticmethod
+    def evidence (st): return f'{Colour.s_evidence}{st}{Colour.s_terminator}'
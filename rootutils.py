@@ -18,7 +18,8 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 ################################################################################
 
-import os
+import sys
+import numpy as np
 import ROOT
 
 class TFileContext(object):
@@ -31,22 +32,98 @@ class TFileContext(object):
 
 def get_list_of_keys_deep(tfile):
     '''
-    Recursively search the TDirectories of a ROOT file and yield the paths to each key.
-    The search is performed depth-first
+    Search the TDirectories of a ROOT file and yield (path, TKey) for each key.
+    The search is performed depth-first, using an explicit stack instead of recursion.
+    Subdirectories read with TKey::ReadObj are appended to their mother directory,
+    so the TKeys stay valid until the file is closed.
+    Only the highest cycle of each name is yielded, like TDirectory::Get does
     '''
-    def get_keys_in_folder(tfolder, path=''):
+    stack = [(tfile, '')]
+    while stack:
+        tfolder, path = stack.pop()
         # logging.debug('tfolder: "%s", path so far: "%s"', tfolder.GetName(), path)
+        seen = set()
         for k in tfolder.GetListOfKeys():
+            name = k.GetName()
+            # The list holds every cycle of a name, the newest first
+            if(name in seen):
+                continue
+            seen.add(name)
+            # Interned, so that the same path from two files is a single object
+            newpath = sys.intern(path + '/' + name if path else name)
             if(k.IsFolder()):
-                newpath = os.path.join(path, k.GetName())
-                # logging.debug('Recursing "%s", newpath: "%s"', k.GetName(), newpath)
-                yield get_keys_in_folder(k.ReadObj(), path=newpath)
+                # logging.debug('Recursing "%s", newpath: "%s"', name, newpath)
+                stack.append((k.ReadObj(), newpath))
             else:
-                yield os.path.join(path, k.GetName())
-
-    for k in tfile.GetListOfKeys():
-        # logging.debug('key: %s', k.GetName())
-        if k.IsFolder():
-            yield from get_keys_in_folder(k.ReadObj(), path=k.GetName())
-        else:
-            yield k.GetName()
+                yield newpath, k
+
+
+def get_key(tfile, path):
+    '''
+    Return the TKey at path in tfile, without walking the whole file.
+    TDirectory::GetKey returns the highest cycle, like get_list_of_keys_deep
+    '''
+    dirname, _, name = path.rpartition('/')
+    tfolder = tfile.GetDirectory(dirname) if dirname else tfile
+    return tfolder.GetKey(name) if tfolder else None
+
+
+def prefetch_keys(tfile, tkeys, cache_size=10*1024*1024):
+    '''
+    Yield the TKeys of tfile in the given order. Their payloads are registered in
+    blocks of up to cache_size bytes with a TFileCacheRead, so that each block is
+    fetched from the file in a single request when the first of its keys is read.
+    The cache is detached from the file once the iteration is over
+    '''
+    tkeys = list(tkeys)
+    cache = ROOT.TFileCacheRead(tfile, cache_size)
+    tfile.SetCacheRead(cache)
+    try:
+        start = 0
+        while start < len(tkeys):
+            cache.Prefetch(0, 0)  # reset the list of blocks
+            stop = start
+            block_size = 0
+            while stop < len(tkeys) and (stop == start or block_size + tkeys[stop].GetNbytes() <= cache_size):
+                k = tkeys[stop]
+                cache.Prefetch(k.GetSeekKey(), k.GetNbytes())
+                block_size += k.GetNbytes()
+                stop += 1
+            yield from tkeys[start:stop]
+            start = stop
+    finally:
+        tfile.SetCacheRead(ROOT.nullptr)
+
+def read_key_payload(tfile, tkey):
+    '''
+    Return a view of the raw (possibly compressed) bytes of the object stored in a TKey, without
+    the key header and without unstreaming it. Return None if the read fails
+    '''
+    # Read the whole record, header included: the read cache only serves reads that
+    # start at the offset of a prefetched block, which is fSeekKey (see prefetch_keys)
+    buf = bytearray(tkey.GetNbytes())
+    if(tfile.ReadBuffer(buf, tkey.GetSeekKey(), tkey.GetNbytes())):
+        return None  # TFile::ReadBuffer returns kTRUE in case of error
+    return memoryview(buf)[tkey.GetKeylen():]  # No copy; memoryviews compare with ==
+
+# Histogram classes that store their bin contents in a plain TArray, with the
+# corresponding numpy dtype. Classes like TProfile compute the content on the fly
+# in GetBinContent, so they must not be read through GetArray().
+# TH*C are left out too: cppyy converts the Char_t* of TArrayC::GetArray() to a str
+_TH_ARRAY_DTYPES = {
+    'TH%d%s' % (dim, t): dtype
+    for dim in (1, 2, 3)
+    for t, dtype in (('D', np.float64), ('F', np.float32), ('I', np.int32), ('S', np.int16))
+}
+
+def get_bin_contents(h):
+    '''
+    Return a zero-copy numpy view of the bin contents of a TH1 (including under/overflow),
+    or None if the class does not expose its contents as a plain array
+    '''
+    dtype = _TH_ARRAY_DTYPES.get(h.ClassName())
+    if(dtype is None):
+        return None
+    if(h.GetBufferLength() > 0):
+        return None  # The entries still in fBuffer are not in fArray yet; GetBinContent empties it
+    return np.frombuffer(h.GetArray(), dtype=dtype, count=h.GetNcells())